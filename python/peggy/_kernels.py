@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Small numeric loops of the matcher, over char code arrays.
+# They are JIT compiled with numba when available (as the parsing
+# machine loop is), and run as plain Python otherwise.
+
+
+def span(codes, pos, n, table):
+    ''' Returns the position of the first char code from pos on (up to n)
+    which is not in the given 256 entry table (e.g. a CharClass one)
+    '''
+    while pos < n and codes[pos] < 256 and table[codes[pos]]:
+        pos += 1
+    return pos
+
+
+try:
+    import numpy
+    from numba import njit
+    span = njit(cache = True)(span)
+except ImportError:
+    numpy = None
+
+
+def buffer(codes):
+    ''' Returns the array of char codes (a bytearray or an array) as
+    the kernels above take it
+    '''
+    if numpy is None:
+        return codes
+    return numpy.frombuffer(codes, dtype = 'B' if isinstance(codes, bytearray) else codes.typecode)
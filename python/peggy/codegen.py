@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Partial evaluation of PEG objects into Python source code.
+# Every non leaf PEG object becomes a recursive descent function
+# match_N(s, pos, n) which returns the position where its match ends
+# in the string s[:n], or -1. Leaves (strings and char sets) are inlined
+# as expressions, so no combinator object is dispatched while matching.
+
+from peg import *
+
+
+class CodegenError(Exception):
+    def __init__(self, msg):
+        self.message = msg
+
+    def __str__(self):
+        return self.message
+
+
+def codegen(symbol):
+    ''' Returns (source, constants): the Python source code of the
+    recognizer functions for the given PEG object, the entry one being
+    match_0, and the dict of constants (char sets, regexps) it uses.
+    Raises CodegenError for unsupported PEG objects.
+    '''
+    names = {} # id(symbol) => function name
+    constants = {}
+    pending = []
+    lines = []
+
+    def function(symbol):
+        if id(symbol) not in names:
+            names[id(symbol)] = 'match_%i' % len(names)
+            pending.append(symbol)
+        return names[id(symbol)]
+
+    def constant(prefix, value):
+        name = '%s%i' % (prefix, len(constants))
+        constants[name] = value
+        return name
+
+    def charset(ranges, negated = False):
+        ''' Returns an expression testing s[pos] against the ranges
+        '''
+        if all(b < CHARCLASS_MASK_LIMIT for a, b in ranges):
+            codes = [x for a, b in ranges for x in range(a, b + 1)]
+            # Char codes, since str and unicode chars 128-255 are unequal
+            name = constant('S', frozenset(codes))
+            return 'ord(s[pos]) %s %s' % ('not in' if negated else 'in', name)
+
+        name = constant('C', CharClass(*[(unichr(a), unichr(b)) for a, b in ranges]))
+        return '%s%s.contains(ord(s[pos]))' % ('not ' if negated else '', name)
+
+    def test(symbol):
+        ''' Returns an expression testing whether a single char leaf
+        matches at pos, or None if symbol is not one
+        '''
+        if isinstance(symbol, Range):
+            return charset([(symbol.lo, symbol.hi)])
+        if isinstance(symbol, NotChar):
+            return charset(symbol.ranges, negated = True)
+        if isinstance(symbol, CharClass):
+            return charset(symbol.ranges)
+        if isinstance(symbol, Dot):
+            return 'True'
+        return None
+
+    def call(symbol):
+        ''' Returns an expression evaluating to the end of the symbol
+        match at pos, or -1
+        '''
+        if isinstance(symbol, String):
+            if not symbol.length:
+                return 'pos'
+            return '(pos + %i if s.startswith(%r, pos) else -1)' % (symbol.length, symbol.pattern)
+
+        if test(symbol) is not None:
+            return '(pos + 1 if pos < n and %s else -1)' % test(symbol)
+
+        if isinstance(symbol, Regular) and symbol.regexp is not None:
+            return '%s(s, pos, n)' % function(symbol)
+
+        if isinstance(symbol, (Ignore, Regular)) or type(symbol) is Symbol:
+            return 'pos' if symbol.symbol is None else call(symbol.symbol)
+
+        return '%s(s, pos, n)' % function(symbol)
+
+    def body(symbol):
+        if isinstance(symbol, (String, Range, CharClass, Dot, Ignore)) or type(symbol) is Symbol \
+                or (isinstance(symbol, Regular) and symbol.regexp is None): # Inlined elsewhere
+            return ['return %s' % call(symbol)]
+
+        if isinstance(symbol, Regular):
+            name = constant('R', symbol.regexp)
+            return ['m = %s.match(s, pos, n)' % name,
+                    'return -1 if m is None else m.end()']
+
+        if isinstance(symbol, Choice):
+            result = []
+            for x in symbol.symbol:
+                result += ['r = %s' % call(x),
+                           'if r >= 0:',
+                           '    return r']
+            return result + ['return -1']
+
+        if isinstance(symbol, Sequence):
+            result = []
+            for x in symbol.symbol:
+                result += ['pos = %s' % call(x),
+                           'if pos < 0:',
+                           '    return -1']
+            return result + ['return pos']
+
+        if isinstance(symbol, Star):
+            if stopString(symbol.symbol) is not None: # Up to the next string
+                return ['r = s.find(%r, pos, n)' % stopString(symbol.symbol),
+                        'return n if r < 0 else r']
+            if test(symbol.symbol) is not None: # A tight loop over chars
+                return ['while pos < n and %s:' % test(symbol.symbol),
+                        '    pos += 1',
+                        'return pos']
+            return ['while True:',
+                    '    r = %s' % call(symbol.symbol),
+                    '    if r < 0 or r == pos:',
+                    '        return pos',
+                    '    pos = r']
+
+        if isinstance(symbol, Plus):
+            return ['return %s' % call(symbol.symbol)]
+
+        if isinstance(symbol, Optional):
+            return ['r = %s' % call(symbol.symbol.symbol[0]),
+                    'return pos if r < 0 else r']
+
+        if isinstance(symbol, And):
+            return ['return -1 if %s < 0 else pos' % call(symbol.symbol)]
+
+        if isinstance(symbol, Not):
+            return ['return pos if %s < 0 else -1' % call(symbol.symbol)]
+
+        if isinstance(symbol, Regexp):
+            raise CodegenError('Regular expressions can not be compiled: %s' % symbol)
+
+        raise CodegenError('Unsupported PEG object %s' % type(symbol).__name__)
+
+    names[id(symbol)] = 'match_0'
+    pending.append(symbol)
+    while pending:
+        symbol = pending.pop(0)
+        lines += ['', '', 'def %s(s, pos, n): # %s' % (names[id(symbol)], symbol.name)]
+        lines += ['    ' + x for x in body(symbol)]
+
+    return '\n'.join(lines[2:]) + '\n', constants
+
+
+def compileRecognizer(symbol):
+    ''' Returns a function recognizer(s, pos) for the given PEG object,
+    which returns the position where its match in the string s ends,
+    or None. Raises CodegenError for unsupported PEG objects.
+    '''
+    source, namespace = codegen(symbol)
+    exec compile(source, '<peg %s>' % symbol.name, 'exec') in namespace
+    entry = namespace['match_0']
+
+    def recognizer(s, pos = 0):
+        result = entry(s, pos, len(s))
+        return None if result < 0 else result
+
+    recognizer.source = source
+    return recognizer
+
+
+
+if __name__ == '__main__':
+    number = Plus(CharClass(('0', '9')))
+    print codegen(Sequence(number, Optional(Sequence('.', number))))[0]
+    R = compileRecognizer(Sequence(number, Optional(Sequence('.', number))))
+    print R('123.45abc'), R('x')
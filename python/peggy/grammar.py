@@ -5,6 +5,7 @@
 # as described at http://pdos.csail.mit.edu/papers/parsing:popl04.pdf
 
 from peg import *
+from optimize import optimize
 
 class Ident(String):
     pass
@@ -14,7 +15,7 @@ EndOfFile = ~Dot()
 EndOfLine = String('\r\n') | '\n' | '\r'
 Space = EndOfLine | ' ' | '\t'
 Comment = Sequence(String('#'), Sequence(~EndOfLine, Dot())* EndOfLine)
-Spacing = Ignore(Star(Space | Comment))
+Spacing = Regular(Ignore(Star(Space | Comment)))
 DOT = Sequence('.', Spacing)
 DOT.name = 'DOT'
 CLOSE = Sequence(')', Spacing)
@@ -27,24 +28,26 @@ AND = Sequence('&', Spacing)
 SLASH = Sequence(Choice('/', '|'), Spacing)
 LEFTARROW = Sequence('<-', Spacing)
 
-Char = Sequence('\\', String('n')|'r'|'t'|"'"|'"'|'['|']'|'\\') | \
+Char = Regular(Sequence('\\', String('n')|'r'|'t'|"'"|'"'|'['|']'|'\\') | \
     Sequence('\\', Range('0', '2'), Range('0', '7'), Range('0', '7')) | \
     Sequence('\\', Range('0', '7'), Optional(Range('0', '7'))) | \
-    Sequence(Not('\\'), Dot())
+    Sequence(Not('\\'), Dot()))
 
 Range_ = Sequence(Char, '-', Char) | Char
 Class = Sequence('[', Sequence(Not(']'), Range_)* ']', Spacing)
 Class.name = 'Class'
-Literal = Sequence("'", Sequence(Not("'"), Char)* "'", Spacing) | \
-    Sequence('"', Sequence(Not('"'), Char)* '"', Spacing) 
+Literal = Sequence(Regular(Sequence("'", Sequence(Not("'"), Char)* "'")), Spacing) | \
+    Sequence(Regular(Sequence('"', Sequence(Not('"'), Char)* '"')), Spacing)
 Literal.name = 'Literal'
 
 IdentStart = Range('a', 'z') | Range('A', 'Z')
 IdentCont = IdentStart | Range('0', '9')
-Identifier = Sequence(IdentStart, IdentCont* Spacing)
+Identifier = Regular(Sequence(IdentStart, Star(IdentCont), Spacing)) # A single regexp match
 
 Expression = Sequence(Symbol, Symbol) # Dummy Object to allow recursion
-Primary = Sequence(Identifier, ~LEFTARROW) | (OPEN, Expression, CLOSE) | Literal | Class | DOT
+IdentifierPrimary = Sequence(Identifier, ~LEFTARROW)
+GroupPrimary = Sequence(OPEN, Expression, CLOSE)
+Primary = IdentifierPrimary | GroupPrimary | Literal | Class | DOT
 Suffix = Sequence(Primary, Optional(QUESTION | STAR | PLUS))
 Prefix = Sequence(Optional(AND | NOT), Suffix)
 Sequence_ = Star(Prefix)
@@ -58,11 +61,6 @@ def Identifier_action(yytext):
 Identifier.action = Identifier_action
 
 
-def Sequence__action(yytext):
-    return Sequence(x() for x in yytext.child)
-Sequence_.action = Sequence__action
-
-
 def DOT_action(yytext):
     return Dot()
 DOT.action = DOT_action
@@ -90,7 +88,7 @@ Char.action = Char_action
 def Sequence__action(yytext):
     ''' Action for Sequence object
     '''
-    return Sequence(*tuple(x() for x in yytext.child))
+    return Sequence(*[x() for x in yytext.child])
 Sequence_.action = Sequence__action
 
 
@@ -111,7 +109,9 @@ def Class_action(yytext):
     tmp = [x.child[1]() for x in yytext.child[1].child[0].child]
     if len(tmp) == 1:
         return tmp[0]
-    return Choice(*tuple(x for x in tmp))
+    if all(isinstance(x, Range) or len(x.pattern) == 1 for x in tmp):
+        return CharClass(*[(x.a, x.b) if isinstance(x, Range) else x.pattern for x in tmp])
+    return Choice(*tmp)
 Class.action = Class_action
 
 
@@ -123,23 +123,20 @@ def Expression_action(yytext):
 Expression.action = Expression_action
     
 
+# Primary alternative => its action
+PRIMARY_ACTIONS = {
+    id(IdentifierPrimary): lambda yytext: yytext.child[0](),
+    id(GroupPrimary): lambda yytext: yytext.child[1](), # ( Expression ) => Return Expression
+    id(Literal): lambda yytext: String(yytext()[1:-1]),
+    id(Class): lambda yytext: yytext(),
+    id(DOT): lambda yytext: yytext(),
+}
+
 def Primary_action(yytext):
     child = yytext.child[0]
-    if child.symbol.name == 'DOT':
-        return child()
-    child = child.child[0]
-    if child.symbol.name == 'Class':
-        return child()
-    child = child.child[0]
-    if child.symbol.name == 'Literal':
-        return String(child()[1:-1])
-    child = child.child[0]
-    if child.symbol.name == 'Sequence':
-        if child.child[1].symbol.name == 'Expression': # ( Expression ) => Return Expression
-            return child.child[1]()
-
-    child = child.child[0]
-    return child()
+    while id(child.symbol) not in PRIMARY_ACTIONS: # Nested (a | b) | c choice
+        child = child.child[0]
+    return PRIMARY_ACTIONS[id(child.symbol)](child)
 Primary.action = Primary_action
 
 
@@ -170,6 +167,14 @@ def Definition_action(yytext):
 Definition.action = Definition_action
 
 
+# Lexical rules are single regexp matches, which are mostly tried again
+# only where they were last tried, so they keep just that match
+for x in (Spacing, Char, Identifier):
+    x.memoize = 'single'
+
+optimize(Grammar)
+
+
 if __name__ == '__main__':
     q = Primary.match(".")
     print q()
@@ -206,5 +211,3 @@ if __name__ == '__main__':
     q = Definition.match('number <- [0-9]+')
     print q()
     print type(q())
-
-
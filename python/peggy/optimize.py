@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Grammar rewrite passes. Each pass replaces PEG subobjects with
+# cheaper equivalent ones, preserving the matched text.
+
+import copy
+
+from peg import *
+from vm import children, charRanges
+
+# Shared instance of each PEG object key (see canonical())
+interned = {}
+
+
+def transform(symbol, rule):
+    ''' Rewrites the PEG object tree bottom up, replacing (in place)
+    every subsymbol x with rule(x). Each object is visited once, so
+    recursive grammars are fine. Returns rule(symbol).
+    '''
+    done = {} # id(symbol) => replacement
+
+    def visit(x):
+        if id(x) in done:
+            return done[id(x)]
+
+        done[id(x)] = x # Recursive references keep the original object
+        if isinstance(x, Plus):
+            x.originalSymbol = visit(x.originalSymbol)
+            x.symbol = Sequence(x.originalSymbol, Star(x.originalSymbol))
+        elif isinstance(x, Sequence): # Also Choice
+            x.symbol = [visit(y) for y in x.symbol]
+            if isinstance(x, Choice):
+                x.prepare()
+        elif isinstance(x, Symbol) and isinstance(x.symbol, Symbol):
+            x.symbol = visit(x.symbol)
+
+        done[id(x)] = rule(x)
+        return done[id(x)]
+
+    return visit(symbol)
+
+
+def alternatives(symbol):
+    ''' Returns the list of alternatives of a (possibly nested) Choice
+    '''
+    if not isinstance(symbol, Choice):
+        return [symbol]
+
+    return sum((alternatives(x) for x in symbol.symbol), [])
+
+
+def notCharset(symbol):
+    ''' Returns the list of (lo, hi) char code ranges a char must not be
+    in to pass the !symbol lookahead, or None if that depends on more
+    than one char. Strings longer than a char are allowed if their first
+    char is also an alternative (e.g. '\r\n' | '\n' | '\r').
+    '''
+    ranges = []
+    longer = []
+    for x in alternatives(symbol):
+        if isinstance(x, String) and x.length == 1:
+            ranges.append((ord(x.pattern), ord(x.pattern)))
+        elif isinstance(x, String) and x.length > 1:
+            longer.append(ord(x.pattern[0]))
+        elif isinstance(x, Range):
+            ranges.append((x.lo, x.hi))
+        elif isinstance(x, CharClass) and not isinstance(x, NotChar):
+            ranges.extend(x.ranges)
+        else:
+            return None
+
+    if not ranges or any(not any(a <= c <= b for a, b in ranges) for c in longer):
+        return None
+
+    return ranges
+
+
+def char(code):
+    return unichr(code) if code > 255 else chr(code)
+
+
+def fuseNotDot(symbol):
+    ''' (!X .) => NotChar(X) when X is a char set
+    This changes the parse tree, so it is only applied to objects whose
+    tree is never seen (see exposed()).
+    '''
+    if not isinstance(symbol, Sequence) or isinstance(symbol, Choice):
+        return symbol
+
+    result = []
+    for x in symbol.symbol:
+        ranges = None
+        if isinstance(x, Dot) and result and isinstance(result[-1], Not):
+            ranges = notCharset(result[-1].symbol)
+
+        if ranges is None:
+            result.append(x)
+        else:
+            result[-1] = NotChar(*[(char(a), char(b)) for a, b in ranges])
+
+    if len(result) == 1 and len(symbol.symbol) == 2 and symbol.action is None \
+            and symbol.name == type(symbol).__name__: # Not a named rule
+        return result[0]
+
+    symbol.symbol = result
+    return symbol
+
+
+def exposed(symbol):
+    ''' Returns the set of ids of the subsymbols whose parse tree can be
+    seen by rule actions. That is, those reachable with no Regular, And
+    or Not object in between, since these only return a flat text.
+    '''
+    result = set()
+    stack = [symbol]
+    while stack:
+        x = stack.pop()
+        if id(x) in result:
+            continue
+
+        result.add(id(x))
+        if not isinstance(x, (And, Not)) and not (isinstance(x, Regular) and x.regexp is not None):
+            stack.extend(children(x))
+
+    return result
+
+
+def head(symbol):
+    ''' Returns the first item of a Sequence with no action, or the
+    symbol itself
+    '''
+    if type(symbol) is Sequence and symbol.symbol and symbol.action is None:
+        return symbol.symbol[0]
+    return symbol
+
+
+def tail(symbol):
+    ''' Returns what is left of a symbol after its head()
+    '''
+    if head(symbol) is symbol:
+        return String('')
+    if len(symbol.symbol) == 2:
+        return symbol.symbol[1]
+    return Sequence(*symbol.symbol[1:])
+
+
+def same(a, b):
+    ''' Returns whether both symbols match the same input the same way
+    '''
+    return a is b or (a.key() is not None and a.key() == b.key())
+
+
+def factorPrefixes(symbol):
+    ''' (p a | p b | c) => (p (a | b) | c)
+    Consecutive alternatives starting with the same symbol only match it
+    once. This changes the parse tree, so it is only applied to choices
+    whose tree is never seen (see exposed()).
+    '''
+    if not isinstance(symbol, Choice):
+        return symbol
+
+    groups = []
+    for x in symbol.symbol:
+        if groups and same(head(x), head(groups[-1][0])) and not (isinstance(head(x), String) and not head(x).length):
+            groups[-1].append(x)
+        else:
+            groups.append([x])
+
+    if len(groups) == len(symbol.symbol):
+        return symbol
+
+    result = [x[0] if len(x) == 1 else
+        Sequence(head(x[0]), factorPrefixes(Choice(*[tail(y) for y in x]))) for x in groups]
+    if len(result) == 1:
+        return result[0]
+
+    symbol.symbol = result
+    symbol.prepare()
+    return symbol
+
+
+def fuse(symbol):
+    ''' ('a' 'b' x) => ('ab' x), ('a' | 'b' | [0-9]) => [ab0-9]
+    and [ab]* => Regular([ab]*) (also +), so runs of literals and char sets are
+    matched at once (the last one by the re module C loop). This changes
+    the parse tree, so it is only applied to objects whose tree is never
+    seen (see exposed()).
+    '''
+    if isinstance(symbol, Choice):
+        ranges = charRanges(symbol)
+        if ranges is None or symbol.action is not None:
+            return symbol
+        return CharClass(*[(char(a), char(b)) for a, b in ranges])
+
+    if isinstance(symbol, (Star, Plus)):
+        x = symbol.originalSymbol if isinstance(symbol, Plus) else symbol.symbol
+        if charRanges(x) is None or isinstance(x, NotChar):
+            return symbol # (!x .)* is already scanned with str.find
+        return Regular(type(symbol)(CharClass(*[(char(a), char(b)) for a, b in charRanges(x)])))
+
+    if type(symbol) is not Sequence:
+        return symbol
+
+    result = []
+    for x in symbol.symbol:
+        if isinstance(x, String) and result and isinstance(result[-1], String):
+            result[-1] = String(result[-1].pattern + x.pattern)
+        else:
+            result.append(x)
+
+    if len(result) == 1 and symbol.action is None:
+        return result[0]
+
+    symbol.symbol = result
+    return symbol
+
+
+def dispatch(symbol):
+    ''' Sets the dispatch table of a Choice: for each next char, the
+    alternatives which might match (i.e. those whose first chars include
+    it, or which could match the empty string). The others are skipped
+    with no call, so the parse tree does not change.
+    '''
+    if not isinstance(symbol, Choice) or symbol.strings is not None:
+        return symbol
+
+    firsts = [firstChars(x) for x in symbol.symbol]
+    if all(x is None or x[1] for x in firsts): # Nothing to skip
+        return symbol
+
+    tables = {} # Shares equal tuples of alternatives
+    symbol.dispatch = []
+    for code in xrange(CHARCLASS_MASK_LIMIT + 1): # The last one is the end of input
+        alternatives = tuple(x for x, first in zip(symbol.symbol, firsts) if first is None or first[1]
+            or (code < CHARCLASS_MASK_LIMIT and any(a <= code <= b for a, b in first[0])))
+        symbol.dispatch.append(tables.setdefault(alternatives, alternatives))
+
+    return symbol
+
+
+def canonical(symbol):
+    ''' Returns the shared instance of a plain (no name, action or memo
+    setting) PEG object with a key, e.g. String('a'), so equal objects
+    share their packrat memo entries. The shared one is a copy, which
+    no user holds. Objects in the parse tree rule actions see are not
+    replaced, since actions might tell them apart.
+    '''
+    key = symbol.key()
+    if key is None or symbol.action is not None or symbol.memoize != 'full' \
+            or symbol.name != type(symbol).__name__:
+        return symbol
+
+    result = interned.get(key)
+    if result is None:
+        result = interned.setdefault(key, copy.copy(symbol))
+    return result
+
+
+def number(symbol):
+    ''' Numbers the memo slot of objects memoizing a single position
+    '''
+    if symbol.memoize == 'single' and symbol.slot is None:
+        symbol.slot = newSlot()
+    return symbol
+
+
+def optimize(symbol):
+    ''' Applies every rewrite pass to the given PEG object (in place).
+    Returns the optimized object, which might be a new one.
+    '''
+    visible = exposed(symbol)
+    symbol = transform(symbol, lambda x: x if id(x) in visible else fuseNotDot(x))
+    visible = exposed(symbol)
+    symbol = transform(symbol, lambda x: x if id(x) in visible else canonical(fuse(factorPrefixes(x))))
+    return transform(symbol, lambda x: number(dispatch(x)))
+
+
+
+if __name__ == '__main__':
+    print optimize(Star(Sequence(Not('b'), Dot())))
+    print optimize(Sequence('#', Star(Sequence(Not(String('\r\n') | '\n' | '\r'), Dot()))))
+    print optimize(Sequence('"', Star(Sequence(Not('"'), Dot())), '"')).match('"abc"d')
+    print optimize(Regular(Sequence('\\', 'n') | Sequence('\\', 't') | 'x'))
+    print optimize(And(Sequence('a', 'b', Star(String('x') | Range('0', '9')))))
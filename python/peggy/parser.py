@@ -1,11 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import inspect
+import hashlib
+import cPickle as pickle
 
+import peg
 from peg import *
 import grammar
+import vm
+import codegen
+from optimize import optimize
+
+
+# Set to True to print every rule PEG object as it gets compiled
+DEBUG = False
 
 
 Definition = grammar.Spacing* grammar.Definition
@@ -14,6 +25,60 @@ def Definition_action(yytext):
 Definition.action = Definition_action
 
 
+# Directory where compiled rules are pickled. None disables the disk cache.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'peggy')
+
+# Compiled rules must be invalidated whenever the PEG classes, the PEG
+# grammar or the optimizer passes (see optimize()) change, so cache entries
+# are keyed on their source code too.
+try:
+    GRAMMAR_HASH = hashlib.sha1(''.join(inspect.getsource(x)
+        for x in (peg, grammar, sys.modules[optimize.__module__], vm))).hexdigest()
+except (IOError, TypeError):
+    GRAMMAR_HASH = None
+
+_compiled = {} # Rule text => (symbol, PEGobject)
+
+
+def compileRule(rule):
+    ''' Returns the (symbol, PEGobject) pair for the given rule text,
+    or None if the rule syntax is invalid. Results are cached in memory
+    and pickled into CACHE_DIR, so warm runs skip the rule parsing.
+    '''
+    if rule in _compiled:
+        return _compiled[rule]
+
+    path = None
+    if CACHE_DIR is not None and GRAMMAR_HASH is not None:
+        key = rule.encode('utf-8') if isinstance(rule, unicode) else rule
+        path = os.path.join(CACHE_DIR, hashlib.sha1(GRAMMAR_HASH + key).hexdigest() + '.pkl')
+        try:
+            with open(path, 'rb') as f:
+                _compiled[rule] = pickle.load(f)
+            return _compiled[rule]
+        except Exception: # Missing, unreadable or stale entry: recompile it
+            pass
+
+    tree = Definition.match(rule)
+    if tree is None:
+        return None
+
+    symbol, PEGobject = tree()
+    result = _compiled[rule] = (symbol, optimize(PEGobject))
+    if path is not None:
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            tmp = '%s.%i' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except (IOError, OSError, pickle.PicklingError):
+            pass
+
+    return result
+
+
 class PEGerror(Exception):
     def __init__(self, msg):
         self.message = msg
@@ -32,23 +97,70 @@ class PEGrule(object):
         if self.rule is None:
             self.rule = ''
 
-        self.peg = Definition.match(self.rule)
-        if self.peg is None:
+        compiled = compileRule(self.rule)
+        if compiled is None:
             raise PEGerror('Invalid rule syntax in function ' + action.func_name)
 
-        self.symbol, self.PEGobject = self.peg()
+        self.symbol, self.PEGobject = compiled
         self.action = action
-        print self.PEGobject
-        print [type(x) for x in self.PEGobject.symbol]
+        self.__peg = None
+        self.__program = self.__machine = self.__recognizer = Undefined
+        if DEBUG:
+            print self.PEGobject
+            print [type(x) for x in self.PEGobject.symbol]
 
     def __call__(self, *args, **kwargs):
         return self.action(*args, **kwargs)
 
+    @property
+    def peg(self):
+        ''' Returns the rule parse tree (parsed on demand, since
+        compiled rules may come from the cache).
+        '''
+        if self.__peg is None:
+            self.__peg = Definition.match(self.rule)
+        return self.__peg
+
+    @property
+    def program(self):
+        ''' Returns the rule compiled for the parsing machine (compiled
+        on first use), or None if it can not be compiled.
+        '''
+        if self.__program is Undefined:
+            try:
+                self.__program = vm.compile_to_bytecode(self.PEGobject)
+            except vm.VMerror:
+                self.__program = None
+        return self.__program
+
+    @property
+    def machine(self):
+        ''' As above, but the program also records the parse tree
+        '''
+        if self.__machine is Undefined:
+            try:
+                self.__machine = vm.compile_to_bytecode(self.PEGobject, captures = True)
+            except vm.VMerror:
+                self.__machine = None
+        return self.__machine
+
+    @property
+    def recognizer(self):
+        ''' Returns the rule compiled into a Python function (compiled
+        on first use), or None if it can not be compiled.
+        '''
+        if self.__recognizer is Undefined:
+            try:
+                self.__recognizer = codegen.compileRecognizer(self.PEGobject)
+            except codegen.CodegenError:
+                self.__recognizer = None
+        return self.__recognizer
+
     @property
     def symbolName(self):
         ''' Returns left part of the rule.
         '''
-        return str(self.peg.child[1].child[0])
+        return self.symbol
 
     @property
     def definition(self):
@@ -60,7 +172,56 @@ class PEGrule(object):
         return '%s <- %s' % (self.symbolName, self.definition)
 
     def match(self, inputSequence, pos = None):
+        ''' Matches the rule against the given input. String inputs
+        are run by the compiled parsing machine, which builds the same
+        parse tree with no recursion. Otherwise (or if the rule could
+        not be compiled) the PEG object is matched, and a raw input gets
+        a fresh InputSeq, so every parse starts with an empty packrat
+        table. An InputSeq keeps (and shares) its own one.
+        '''
+        if not isinstance(inputSequence, InputSeq):
+            inputSequence = InputSeq(inputSequence)
+
+        if pos is None:
+            pos = inputSequence.pos
+
+        if self.machine is not None and isinstance(inputSequence.inputSeq, basestring):
+            return self.machine.match(inputSequence, pos)
+
         return self.PEGobject.match(inputSequence, pos)
+
+    def nodes(self, inputSequence, pos = None):
+        ''' As match(), but returns the parse tree in columnar form (a
+        vm.Nodes, with no YYtext object), or None if it does not match.
+        Only for rules the parsing machine compiles.
+        '''
+        if self.machine is None:
+            raise PEGerror('Rule can not be compiled for the parsing machine: ' + self.symbol)
+
+        if not isinstance(inputSequence, InputSeq):
+            inputSequence = InputSeq(inputSequence)
+
+        if pos is None:
+            pos = inputSequence.pos
+
+        return self.machine.nodes(inputSequence, pos)
+
+    def recognize(self, inputSequence, pos = 0):
+        ''' Returns the position where the rule match ends, or None
+        if it does not match. No parse tree is built: string inputs
+        are matched by the rule generated Python code, unless the
+        parsing machine is JIT compiled. Otherwise the parsing machine
+        is run, unless the rule could not be compiled.
+        '''
+        seq = inputSequence.inputSeq if isinstance(inputSequence, InputSeq) else inputSequence
+        if self.recognizer is not None and vm.numpy is None and isinstance(seq, basestring):
+            return self.recognizer(seq, pos)
+
+        if self.program is None:
+            result = self.PEGobject.match(inputSequence, pos)
+            return None if result is None else pos + len(result)
+
+        return self.program.run(inputSequence, pos)
         
 
 
@@ -2,42 +2,102 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import re
+import sre_parse
+import threading
+import itertools
+from array import array
+from bisect import bisect_right
 
 from stream import Stream
+from _kernels import span, buffer
+
+# Regexp objects use the (non backtracking, linear time) re2 engine
+# when available
+try:
+    import re2
+except ImportError:
+    re2 = None
 
 # Constant for getting "Undefined" values
 Undefined = object()
 
+# Char codes below this limit are tested against a CharClass table.
+# Wider (unicode) ranges are bisected instead, so a class like
+# [\u0100-\uffff] does not need a 64K entry table.
+CHARCLASS_MASK_LIMIT = 256
+
+# Highest char code
+MAX_CHAR_CODE = sys.maxunicode
+
+# Returns the next single slot memo number (see Symbol.slot)
+newSlot = itertools.count().next
+
+# Ids of the symbols being printed by Symbol.__str__, per thread,
+# so printing recursive grammars does not write to them
+printing = threading.local()
+
 
 class Memo(object):
     ''' A memoizing table object. Returns Undefined if the object does not
-    exist in the dictionary
+    exist in the dictionary.
+    There is a table per symbol, keyed by position alone, so lookups
+    need no (symbol, pos) tuple.
+    Single slot memos are two lists indexed by the symbol slot number,
+    holding the last position it was parsed at and its result.
     '''
+    __slots__ = ('seq', 'tables', 'keys', 'values')
+
     def __init__(self, inputSeq):
         ''' Initialize with an input Seq or sequence object object
         '''
         self.seq = inputSeq if isinstance(inputSeq, InputSeq) else InputSeq(inputSeq)
-        self.memo = {}
+        self.tables = {} # symbol => {pos: result}
+        self.keys = [] # slot => pos
+        self.values = [] # slot => result
+
+    def table(self, symbol):
+        ''' Returns the {pos: result} table of the given symbol
+        '''
+        result = self.tables.get(symbol)
+        if result is None:
+            result = self.tables[symbol] = {}
+        return result
 
     def __call__(self, symbol, pos):
-        return self.memo.get((symbol, pos), Undefined)
+        return self.table(symbol).get(pos, Undefined)
 
     def __getitem__(self, k):
-        return self.memo.get(k, Undefined)
+        return self(*k)
 
     def __setitem__(self, k, val):
-        self.memo[k] = val
+        self.table(k[0])[k[1]] = val
+
+    def clear(self):
+        ''' Drops every memoized entry (i.e. starts a new packrat table)
+        '''
+        self.tables.clear()
+        del self.keys[:], self.values[:]
+
+    def grow(self, size):
+        ''' Makes room for single slot memos numbered below size
+        '''
+        self.keys.extend([-1] * (size - len(self.keys)))
+        self.values.extend([Undefined] * (size - len(self.values)))
 
 
 class InputSeq(object):
     ''' Stores the input text, and the current position.
     Also contains a shared look up table for memoization.
     '''
+    __slots__ = ('inputSeq', 'pos', 'memo', '__codes')
+
     def __init__(self, inputSeq, pos = 0):
         self.inputSeq = inputSeq
         self.pos = pos
         self.memo = Memo(self)
+        self.__codes = None
 
     def __getitem__(self, k):
         return self.inputSeq[k]
@@ -45,32 +105,128 @@ class InputSeq(object):
     def __len__(self):
         return len(self.inputSeq)
 
+    def startswith(self, pattern, pos):
+        ''' Returns whether the input at pos starts with the given
+        string, with no slice copy for string inputs.
+        '''
+        try:
+            if isinstance(self.inputSeq, basestring):
+                return self.inputSeq.startswith(pattern, pos)
+            return self.inputSeq[pos:pos + len(pattern)] == pattern
+        except UnicodeDecodeError: # Non ASCII str pattern, unicode input
+            return False
+
+    def find(self, pattern, pos):
+        ''' Returns the position of the next occurrence of the given
+        string from pos on, or -1. Only for string inputs.
+        '''
+        try:
+            return self.inputSeq.find(pattern, pos)
+        except UnicodeDecodeError: # As in startswith
+            return -1
+
+    @property
+    def codes(self):
+        ''' The input as a sequence of char codes (ints), built on
+        first use, so char tests are integer compares.
+        '''
+        if self.__codes is None:
+            if isinstance(self.inputSeq, str):
+                self.__codes = bytearray(self.inputSeq)
+            elif isinstance(self.inputSeq, unicode):
+                self.__codes = array('i', [ord(c) for c in self.inputSeq])
+            else:
+                self.__codes = Codes(self.inputSeq)
+        return self.__codes
+
+
+class Codes(object):
+    ''' Char codes view of an input with no string type (e.g. a Stream)
+    '''
+    __slots__ = ('inputSeq',)
+
+    def __init__(self, inputSeq):
+        self.inputSeq = inputSeq
+
+    def __getitem__(self, k):
+        return ord(self.inputSeq[k])
+
+    def __len__(self):
+        return len(self.inputSeq)
+
+
+# Children of a YYtext with none (shared)
+NOCHILD = ()
+
 
 class YYtext(object):
     ''' This class stores a recognized yytext,
     and a position where it was recognized in the input.
+    There is one per match, so attributes are slots (no __dict__).
+    The end position of the match is kept up to date, so len() does
+    not need to walk the children. Most matches have no children (e.g.
+    strings, chars or lookaheads), so they share the empty NOCHILD tuple
+    until a children list is needed.
     '''
+    __slots__ = ('symbol', 'yytext', 'pos', 'name', '_child', '_end')
+
     def __init__(self, symbol, pos, text, name = None):
         self.symbol = symbol # Symbol Instance which create this module
         self.yytext = text
         self.pos = pos
-        self.child = []
+        self._child = NOCHILD
+        self._end = pos + len(text)
         self.name = name if name is not None else symbol.__class__.name
 
+    def __get_child(self):
+        if self._child is NOCHILD:
+            self._child = []
+        return self._child
+
+    def __set_child(self, child):
+        self._child = child
+        self._end = self.pos + len(self.yytext) + sum(len(x) for x in child)
+
+    child = property(__get_child, __set_child)
+
     def __str__(self):
-        return self.yytext + ''.join(str(x) for x in self.child)
+        # Not recursive, so trees deeper than the recursion limit (see
+        # matchDeep) can be printed too
+        result = []
+        stack = [self]
+        while stack:
+            x = stack.pop()
+            if type(x).__str__ != YYtext.__str__: # e.g. YYignore
+                result.append(x.__str__())
+                continue
+            result.append(x.yytext)
+            stack.extend(reversed(x._child))
+
+        return ''.join(result)
 
     def __len__(self):
-        return len(self.yytext) + sum(len(x) for x in self.child)
+        return self._end - self.pos
 
     def __add__(self, other):
-        if self.pos + len(self) != other.pos:
+        if self._end != other.pos:
             return Undefined
 
         result = YYtext(self.symbol, self.pos, self.yytext, name = self.name)
-        result.child = self.child + [other]
+        result.child = list(self._child) + [other]
         return result
 
+    def extend(self, other):
+        ''' Appends (in place) the match of other, which must start
+        where this one ends. Only for objects not shared yet (i.e. the
+        one being parsed).
+        '''
+        if self._child is NOCHILD:
+            self._child = [other]
+        else:
+            self._child.append(other)
+        self._end = other._end
+        return self
+
     def flatten(self):
         ''' Returns an copy of this object, flattened.
         '''
@@ -91,6 +247,8 @@ class YYignore(YYtext):
     ''' As above, but returns '' for str method.
     Useful for discarding matches.
     '''
+    __slots__ = ('ignored',)
+
     def __init__(self, symbol, pos, text, ignored, name = None):
         YYtext.__init__(self, symbol, pos, text, name)
         self.ignored = ignored 
@@ -102,10 +260,20 @@ class YYignore(YYtext):
 class Symbol(object): 
     ''' Empty / Epsilon symbol
     '''
-    instr = False
     __name = None
     action = None
 
+    # How match() memoizes parse() results (in the input memo, so the
+    # grammar objects are never written while parsing):
+    # 'full': every position, in the packrat table. Guarantees linear time.
+    # 'single': only the last one (i.e. a forgetful memo: less overhead,
+    # as most symbols are only tried again at the position they were
+    # last tried at), in the slot optimize() numbers. Grammars backtracking
+    # a lot might take exponential time, so rules must opt in.
+    # 'none': parse() is always called.
+    memoize = 'full'
+    slot = None # Single slot memo number, set by optimize()
+
     def __get_name(self):
         if self.__name is None:
             return self.__class__.__name__
@@ -116,39 +284,108 @@ class Symbol(object):
 
     name = property(__get_name, __set_name)
 
+    def key(self):
+        ''' Returns a hashable key, equal for symbols matching the same
+        input the same way (e.g. two String('a') objects), or None if
+        that is not known (i.e. it is mutable, as Sequence and Choice
+        objects are). Equal symbols are only shared once optimized, and
+        only those with no name, action or memoize set (see canonical()
+        in optimize.py).
+        '''
+        return None
+
     def __init__(self):
         self.symbol = None
+
+    def __getstate__(self):
+        ''' Pickles and copies drop the slot number, which is only unique
+        within this process
+        '''
+        state = self.__dict__.copy()
+        state.pop('slot', None)
+        return state
     
     def parse(self, inputSequence, pos):
-        return YYtext(self, pos, '', name = name) if self.symbol is None else self.symbol.parse(inputSequence, pos)
+        return YYtext(self, pos, '', name = self.name) if self.symbol is None else self.symbol.parse(inputSequence, pos)
 
     def match(self, inputSequence, pos = None):
         ''' Tries first to get the memoized value in the table entry.
         If not found, recursively calls the symbol.parse() method.
         '''
-        if not isinstance(inputSequence, InputSeq):
-            inputSequence = InputSeq(inputSequence)
+        if not isinstance(inputSequence, InputSeq): # A top level call
+            return self.matchDeep(InputSeq(inputSequence), pos)
 
         if pos is None:
             pos = inputSequence.pos
 
-        result = inputSequence.memo(self, pos)
+        if self.memoize != 'full':
+            if self.memoize == 'none':
+                return self.parse(inputSequence, pos)
+
+            i = self.slot
+            if i is not None: # Else not optimized yet: in the packrat table
+                memo = inputSequence.memo
+                try:
+                    if memo.keys[i] == pos:
+                        return memo.values[i]
+                except IndexError:
+                    memo.grow(i + 1)
+
+                result = self.parse(inputSequence, pos)
+                memo.keys[i] = pos
+                memo.values[i] = result
+                return result
+
+        # Packrat table: each (symbol, pos) pair is parsed at most once
+        tables = inputSequence.memo.tables
+        table = tables.get(self)
+        if table is None:
+            table = tables[self] = {}
+
+        result = table.get(pos, Undefined)
         if result is Undefined:
-            result = self.parse(inputSequence, pos)
-            inputSequence.memo[(self, pos)] = result
+            result = table[pos] = self.parse(inputSequence, pos)
         return result
 
+    def matchDeep(self, inputSequence, pos = None):
+        ''' As match(), but inputs nesting deeper than the recursion limit
+        are matched by the parsing machine (see vm.py), which keeps its
+        backtrack stack in an array, so it is not limited.
+        Only len(), str() and the positions of such a tree are usable:
+        rule actions (i.e. calling it) still recurse once per level, so
+        they exceed the recursion limit as the tree walker did.
+        '''
+        try:
+            return self.match(inputSequence, pos)
+        except RuntimeError:
+            error = sys.exc_info()
+            if 'recursion' not in str(error[1]):
+                raise
+
+        import vm # Not at module level, since vm imports this module
+        try:
+            program = vm.compile_to_bytecode(self, captures = True)
+        except vm.VMerror: # Unsupported: report the original error
+            raise error[0], error[1], error[2]
+
+        return program.match(inputSequence, inputSequence.pos if pos is None else pos)
+
     def __str__(self):
         ''' Returns a string (recursive) representation
         of the object avoiding reentrance.
         '''
-        if self.instr:
+        visited = getattr(printing, 'visited', None)
+        if visited is None:
+            visited = printing.visited = set()
+
+        if id(self) in visited:
             return self.name
 
-        self.instr = True
-        result = '' if self.symbol is None else self.toStr()
-        self.instr = False
-        return result
+        visited.add(id(self))
+        try:
+            return '' if self.symbol is None else self.toStr()
+        finally:
+            visited.discard(id(self))
 
     def toStr(self):
         return ''
@@ -198,15 +435,15 @@ class String(Symbol):
         self.pattern = pattern # The string to be recognized
         self.length = len(pattern)
 
+    def key(self):
+        return (type(self), type(self.pattern), self.pattern)
+
     
     def parse(self, inputSequence, pos):
         ''' Returns an YYtext Symbol if the string can be parsed from
         the input, at the given position. Returns None otherwise.
         '''
-        if len(inputSequence[pos:]) < len(self.pattern):
-            return None
-
-        if inputSequence[pos:pos + self.length] != self.pattern:
+        if not inputSequence.startswith(self.pattern, pos):
             return None
 
         return YYtext(self, pos, self.pattern, self.name)
@@ -218,18 +455,54 @@ class String(Symbol):
         return "'" + self.pattern + "'"
 
 
+def looksBehind(pattern):
+    ''' Returns whether the given regular expression tests the text
+    before the position it is matched at (i.e. uses ^, \\A, \\b, \\B or
+    lookbehinds), or can not be parsed by sre.
+    '''
+    def walk(x):
+        if isinstance(x, sre_parse.SubPattern):
+            return any(op == sre_parse.AT and av not in (sre_parse.AT_END, sre_parse.AT_END_STRING) or
+                op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT) and av[0] < 0 or walk(av) for op, av in x)
+        if isinstance(x, (tuple, list)):
+            return any(walk(y) for y in x)
+        return False
+
+    try:
+        return walk(sre_parse.parse(pattern))
+    except Exception: # e.g. re2 only syntax
+        return True
+
+
 class Regexp(Symbol):
     ''' Matches the given string as a regular expression.
+    Patterns are compiled by re2 if installed, unless they use syntax
+    it lacks (e.g. backreferences or lookarounds), then by re.
+    String inputs are matched in place (no slice copy), unless the
+    pattern looks behind (see looksBehind), so it always sees the input
+    as starting at the match position.
     '''
     def __init__(self, pattern):
         self.pattern = pattern # The string to be recognized
-        self.symbol = re.compile(self.pattern)
+        self.inPlace = not looksBehind(pattern)
+        self.symbol = None
+        if re2 is not None:
+            try:
+                self.symbol = re2.compile(self.pattern)
+            except Exception: # re2.error, which bindings do not agree on
+                pass
+        if self.symbol is None:
+            self.symbol = re.compile(self.pattern)
 
     def parse(self, inputSequence, pos):
         ''' Returns an YYtext Symbol if al the regexp is matched
         at the given position. None otherwise.
         '''
-        match = self.symbol.match(inputSequence[pos:])
+        seq = inputSequence.inputSeq
+        if self.inPlace and isinstance(seq, basestring):
+            match = self.symbol.match(seq, pos)
+        else:
+            match = self.symbol.match(seq[pos:])
         if match is not None:
             return YYtext(self, pos, match.group(), name = self.name)
 
@@ -257,7 +530,7 @@ class Sequence(Symbol):
             if tmp is None:
                 return None
 
-            result += tmp;
+            result.extend(tmp)
 
         return result
 
@@ -277,9 +550,33 @@ class Star(Symbol):
         as much input as possible.
         '''
         result = YYtext(self, pos, '')
+        seq = inputSequence.inputSeq
+        stop = stopString(self.symbol) if isinstance(seq, basestring) else None
+        if stop is not None: # (!s .)* => Up to the next s
+            end = inputSequence.find(stop, pos)
+            result.child = [self.symbol.parse(inputSequence, i) for i in xrange(pos, len(seq) if end < 0 else end)]
+            return result
+
+        if isChar(self.symbol): # A tight loop, with no memo lookups
+            symbol = self.symbol
+            parse = symbol.parse
+            child = result._child = []
+            if type(symbol) is CharClass and isinstance(seq, basestring): # Table lookups first
+                end = span(buffer(inputSequence.codes), pos, len(seq), buffer(symbol.table))
+                child.extend(YYtext(symbol, i, seq[i], symbol.name) for i in xrange(pos, end))
+                pos = end
+
+            tmp = parse(inputSequence, pos)
+            while tmp is not None:
+                child.append(tmp)
+                tmp = parse(inputSequence, tmp._end)
+            if child:
+                result._end = child[-1]._end
+            return result
+
         tmp = self.symbol.match(inputSequence, pos)
         while tmp is not None and len(tmp):
-            result += tmp
+            result.extend(tmp)
             tmp = self.symbol.match(inputSequence, pos + len(result))
 
         return result
@@ -289,6 +586,35 @@ class Star(Symbol):
 
 
 
+def stopString(symbol):
+    ''' Returns s if the PEG object is (!s .) (which matches any char
+    not starting a string s), or None. A Star over it matches up to the
+    next s in the input, so it is found with str.find (i.e. memchr).
+    '''
+    if isinstance(symbol, NotChar):
+        if len(symbol.ranges) == 1 and symbol.ranges[0][0] == symbol.ranges[0][1] < 128:
+            return chr(symbol.ranges[0][0])
+        return None
+
+    if type(symbol) is Sequence and len(symbol.symbol) == 2 and isinstance(symbol.symbol[0], Not) \
+            and isinstance(symbol.symbol[0].symbol, String) and symbol.symbol[0].symbol.length \
+            and isinstance(symbol.symbol[1], Dot):
+        return symbol.symbol[0].symbol.pattern
+
+    return None
+
+
+def isChar(symbol):
+    ''' Returns whether the PEG object always matches a single char
+    or nothing (e.g. 'a', [a-z], . or 'a' | 'b')
+    '''
+    if isinstance(symbol, String):
+        return symbol.length == 1
+    if isinstance(symbol, Choice):
+        return symbol.table is not None
+    return isinstance(symbol, (Range, CharClass, Dot))
+
+
 class Plus(Symbol):
     ''' Matches 1 or more symbol occurrences
     '''
@@ -298,7 +624,15 @@ class Plus(Symbol):
         self.originalSymbol = symbol
 
     def parse(self, inputSequence, pos):
-        return self.symbol.match(inputSequence, pos)
+        ''' Builds the (symbol symbol*) Sequence match in place, with
+        no memo lookup for the Sequence itself.
+        '''
+        first, rest = self.symbol.symbol
+        tmp = first.match(inputSequence, pos)
+        if tmp is None:
+            return None
+
+        return YYtext(self.symbol, pos, '').extend(tmp).extend(rest.match(inputSequence, tmp._end))
 
     def toStr(self):
         return str(self.originalSymbol) + '+'
@@ -308,14 +642,72 @@ class Plus(Symbol):
 class Choice(Sequence):
     ''' Returns the 1st symbol that matches, None otherwise
     '''
+    def __init__(self, *symbols):
+        ''' Init with Choice(symbol1, symbol2, symbol3...)
+        '''
+        Sequence.__init__(self, *symbols)
+        self.prepare()
+
+    def prepare(self):
+        ''' Precomputes the fast paths below from the alternatives.
+        Must be called again if they are replaced.
+        '''
+        # All String alternatives (e.g. '\r\n' | '\n' | '\r') are tried in
+        # order with str.startswith, with no per alternative memo lookup
+        self.strings = tuple(self.symbol) if all(isinstance(x, String) for x in self.symbol) else None
+
+        # Single char alternatives (e.g. ' ' | '\t') are looked up in a 128
+        # entry table holding the (1 based) index of the first one matching.
+        # ASCII only, since str and unicode chars 128-255 are unequal.
+        self.table = None
+        if self.strings and all(x.length == 1 and ord(x.pattern) < 128 for x in self.strings):
+            self.table = bytearray(128)
+            for i, x in reversed(list(enumerate(self.strings))):
+                self.table[ord(x.pattern)] = i + 1
+
+        # Alternatives worth trying for each next char code (< 256, or 256
+        # at the end of the input). Set by optimize(), once the grammar
+        # is complete, since alternatives might not be defined yet.
+        self.dispatch = None
+
     def parse(self, inputSequence, pos):
-        for symbol in self.symbol:
+        if self.table is not None:
+            if pos >= len(inputSequence):
+                return None
+
+            code = inputSequence.codes[pos]
+            i = self.table[code] if code < 128 else 0
+            if not i:
+                return None
+
+            symbol = self.strings[i - 1]
+            return YYtext(self, pos, '').extend(YYtext(symbol, pos, symbol.pattern, symbol.name))
+
+        seq = inputSequence.inputSeq
+        if self.strings is not None and isinstance(seq, basestring):
+            for symbol in self.strings:
+                try:
+                    if seq.startswith(symbol.pattern, pos):
+                        return YYtext(self, pos, '').extend(YYtext(symbol, pos, symbol.pattern, symbol.name))
+                except UnicodeDecodeError: # As in InputSeq.startswith
+                    pass
+            return None
+
+        symbols = self.symbol
+        if self.dispatch is not None:
+            if pos >= len(inputSequence):
+                symbols = self.dispatch[CHARCLASS_MASK_LIMIT]
+            elif inputSequence.codes[pos] < CHARCLASS_MASK_LIMIT:
+                symbols = self.dispatch[inputSequence.codes[pos]]
+
+        tmp = None
+        for symbol in symbols:
             tmp = symbol.match(inputSequence, pos)
             if tmp is not None:
                 break
         
         if tmp is not None:
-            tmp = YYtext(self, pos, '') + tmp
+            tmp = YYtext(self, pos, '').extend(tmp)
         return tmp
 
     def toStr(self):
@@ -330,7 +722,15 @@ class Optional(Symbol):
         self.symbol = Choice(symbol, String(''))
 
     def parse(self, inputSequence, pos):
-        return self.symbol.match(inputSequence, pos)
+        ''' Builds the (symbol | '') Choice match in place, with no memo
+        lookup for the Choice itself.
+        '''
+        symbol, empty = self.symbol.symbol
+        tmp = symbol.match(inputSequence, pos)
+        if tmp is None:
+            tmp = YYtext(empty, pos, '', empty.name)
+
+        return YYtext(self.symbol, pos, '').extend(tmp)
 
     def toStr(self):
         return str(self.symbol.symbol[0]) + '?'
@@ -343,8 +743,12 @@ class And(Symbol):
     def __init__(self, symbol):
         self.symbol = Symbol.symbol(symbol)
 
+    def key(self):
+        key = self.symbol.key() if isinstance(self.symbol, Symbol) else None
+        return None if key is None else (type(self), key)
+
     def parse(self, inputSequence, pos):
-        tmp = self.symbol.match(inputSequence, pos)
+        tmp = self.symbol.parse(inputSequence, pos) # Discarded, so not memoized
         return None if tmp is None else YYtext(self, pos, '', name = self.name)
 
     def toStr(self):
@@ -358,8 +762,12 @@ class Not(Symbol):
     def __init__(self, symbol):
         self.symbol = Symbol.symbol(symbol)
 
+    def key(self):
+        key = self.symbol.key() if isinstance(self.symbol, Symbol) else None
+        return None if key is None else (type(self), key)
+
     def parse(self, inputSequence, pos):
-        tmp = self.symbol.match(inputSequence, pos)
+        tmp = self.symbol.parse(inputSequence, pos) # Discarded, so not memoized
         return None if tmp is not None else YYtext(self, pos, '', name = self.name)
 
     def toStr(self):
@@ -382,16 +790,122 @@ class Dot(Symbol):
         return '.'
 
 
-class Range(Regexp):
+class Range(Symbol):
     ''' Returns if a char is in the range of a, b.
     If b is not specified, then the range will be a, a
+    The char code is compared against the bounds (no regexp is used).
     '''
     def __init__(self, a, b = None):
         if b is None:
             b = a
         self.a = a
         self.b = b
-        Regexp.__init__(self, '[' + a + '-' + b + ']')
+        self.lo = ord(a)
+        self.hi = ord(b)
+        self.pattern = '[' + a + '-' + b + ']'
+
+    def key(self):
+        return (type(self), type(self.a), self.a, self.b)
+
+    def parse(self, inputSequence, pos):
+        ''' Returns an YYtext Symbol if the char code at the given
+        position is within the range. None otherwise.
+        '''
+        if pos >= len(inputSequence) or not self.lo <= inputSequence.codes[pos] <= self.hi:
+            return None
+
+        return YYtext(self, pos, inputSequence[pos], name = self.name)
+
+    def __str__(self):
+        return self.toStr()
+
+    def toStr(self):
+        return '/' + self.pattern + '/'
+
+
+class CharClass(Symbol):
+    ''' Matches a single char belonging to a set of chars and ranges,
+    like the PEG [a-zA-Z0-9_] class. Membership is tested against
+    a 256 entry table (one byte per char code) computed at construction
+    time, so a match costs the same regardless of the number of ranges.
+    Wider char codes are searched in the (sorted) ranges.
+    '''
+    def __init__(self, *ranges):
+        ''' Init with CharClass('_', ('a', 'z'), ('0', '9'), ...)
+        Overlapping and adjacent ranges are merged.
+        '''
+        codes = sorted((ord(x), ord(x)) if isinstance(x, basestring) else (ord(x[0]), ord(x[1]))
+            for x in ranges)
+        self.ranges = []
+        for a, b in codes:
+            if self.ranges and a <= self.ranges[-1][1] + 1:
+                self.ranges[-1][1] = max(b, self.ranges[-1][1])
+            else:
+                self.ranges.append([a, b])
+
+        self.table = bytearray(CHARCLASS_MASK_LIMIT)
+        self.wide = []
+        for a, b in self.ranges:
+            for code in xrange(a, min(b + 1, CHARCLASS_MASK_LIMIT)):
+                self.table[code] = 1
+            if b >= CHARCLASS_MASK_LIMIT:
+                self.wide.append((max(a, CHARCLASS_MASK_LIMIT), b))
+        self.wideStart = [a for a, b in self.wide]
+
+    def parse(self, inputSequence, pos):
+        ''' Returns an YYtext Symbol if the char at the given position
+        belongs to the class. None otherwise.
+        '''
+        if pos >= len(inputSequence):
+            return None
+
+        code = inputSequence.codes[pos]
+        if not (self.table[code] if code < CHARCLASS_MASK_LIMIT else self.contains(code)):
+            return None
+
+        return YYtext(self, pos, inputSequence[pos], name = self.name)
+
+    def contains(self, code):
+        ''' Returns whether the given char code belongs to the class
+        '''
+        if code < CHARCLASS_MASK_LIMIT:
+            return self.table[code]
+
+        i = bisect_right(self.wideStart, code) - 1
+        return i >= 0 and code <= self.wide[i][1]
+
+    def __str__(self):
+        return self.toStr()
+
+    def toStr(self):
+        def escape(code):
+            c = unichr(code) if code >= CHARCLASS_MASK_LIMIT else chr(code)
+            return '\\' + c if c in '\\]-' else c
+
+        return '[' + ''.join(escape(a) if a == b else escape(a) + '-' + escape(b)
+            for a, b in self.ranges) + ']'
+
+
+class NotChar(CharClass):
+    ''' Matches any single char NOT belonging to the given set of chars
+    and ranges. This is the (!X .) PEG idiom, with X a char class,
+    fused into a single test.
+    '''
+    def parse(self, inputSequence, pos):
+        ''' Returns an YYtext Symbol if there is a char at the given
+        position and it does not belong to the class. None otherwise.
+        '''
+        if pos >= len(inputSequence):
+            return None
+
+        code = inputSequence.codes[pos]
+        if self.table[code] if code < CHARCLASS_MASK_LIMIT else self.contains(code):
+            return None
+
+        return YYtext(self, pos, inputSequence[pos], name = self.name)
+
+    def toStr(self):
+        return '(!' + CharClass.toStr(self) + ' .)'
 
 
 class Ignore(Symbol):
@@ -404,7 +918,8 @@ class Ignore(Symbol):
     def parse(self, inputSequence, pos):
         result = self.symbol.parse(inputSequence, pos)
         if result is not None:
-            result = YYignore(self, pos, str(result), result, name = self.name)
+            # The input matched, not str(result), which lacks nested ignored text
+            result = YYignore(self, pos, inputSequence[pos:pos + len(result)], result, name = self.name)
 
         return result
 
@@ -412,6 +927,248 @@ class Ignore(Symbol):
         return ''
 
 
+class NotRegular(Exception):
+    ''' Raised by toRegexp() on PEG objects with no regexp equivalent
+    '''
+
+
+def toRegexp(symbol, ignored = None):
+    ''' Translates a regular PEG object (no recursion, no Regexp other
+    than Range, no Ignore but the root one) into an equivalent regular
+    expression source string.
+    PEG choices and repetitions never backtrack, so they are made
+    atomic with the (?=(...))\\N idiom. Raises NotRegular otherwise.
+    If an ignored list is given, nested Ignore objects (not repeated
+    nor in lookaheads) are allowed too: they are translated into
+    capture groups, whose numbers are appended to that list.
+    '''
+    groups = [0]
+    path = set()
+    loops = [0] # Repetitions and lookaheads being translated
+
+    def atomic(fmt, *symbols):
+        groups[0] += 1 # Groups are numbered by their opening parenthesis
+        group = groups[0]
+        return '(?=(' + fmt % '|'.join(translate(x) for x in symbols) + '))\\' + str(group)
+
+    def alternatives(symbol, seen):
+        ''' (a|b)|c is flattened into a|b|c
+        '''
+        result = []
+        for x in symbol.symbol:
+            if isinstance(x, Choice) and id(x) not in seen:
+                seen.add(id(x))
+                result.extend(alternatives(x, seen))
+            else:
+                result.append(x)
+        return result
+
+    def charset(ranges, negated = False):
+        def escape(code):
+            c = unichr(code) if code >= CHARCLASS_MASK_LIMIT else chr(code)
+            return '\\' + c if c in '\\]^-' else c
+
+        return ('[^' if negated else '[') + ''.join(escape(a) if a == b else escape(a) + '-' + escape(b)
+            for a, b in ranges) + ']'
+
+    def translate(symbol, root = False):
+        if id(symbol) in path:
+            raise NotRegular('Recursive symbol %s' % symbol.name)
+
+        path.add(id(symbol))
+        try:
+            if isinstance(symbol, String):
+                return re.escape(symbol.pattern)
+            if isinstance(symbol, Range):
+                return charset([(ord(symbol.a), ord(symbol.b))])
+            if isinstance(symbol, NotChar):
+                return charset(symbol.ranges, negated = True)
+            if isinstance(symbol, CharClass):
+                return charset(symbol.ranges)
+            if isinstance(symbol, Dot):
+                return '.'
+            if isinstance(symbol, Choice):
+                return atomic('%s', *alternatives(symbol, set(path)))
+            if isinstance(symbol, Sequence):
+                return ''.join(translate(x) for x in symbol.symbol)
+            if isinstance(symbol, Optional):
+                return atomic('(?:%s)?', symbol.symbol.symbol[0])
+            loops[0] += 1
+            try:
+                if isinstance(symbol, Star):
+                    return atomic('(?:%s)*', symbol.symbol)
+                if isinstance(symbol, Plus):
+                    return atomic('(?:%s)+', symbol.originalSymbol)
+                if isinstance(symbol, And):
+                    return '(?=' + translate(symbol.symbol) + ')'
+                if isinstance(symbol, Not):
+                    return '(?!' + translate(symbol.symbol) + ')'
+            finally:
+                loops[0] -= 1
+            if isinstance(symbol, Ignore) and not root: # Would change str() of the match
+                if ignored is None or loops[0]:
+                    raise NotRegular('Nested Ignore symbol')
+                groups[0] += 1
+                ignored.append(groups[0])
+                return '(' + translate(symbol.symbol) + ')'
+            if isinstance(symbol, (Ignore, Regular)):
+                return translate(symbol.symbol, root)
+            if type(symbol) is Symbol:
+                return '' if symbol.symbol is None else translate(symbol.symbol)
+            raise NotRegular('Not a regular symbol: %s' % type(symbol).__name__)
+        finally:
+            path.discard(id(symbol))
+
+    return translate(symbol, root = True)
+
+
+def firstChars(symbol):
+    ''' Returns (ranges, nullable) for a PEG object: the list of (lo, hi)
+    char code ranges a non empty match can start with, and whether it
+    matches the empty string when the next char is not in them.
+    Returns None if that can not be told (e.g. for lookaheads, Regexp
+    or recursive symbols).
+    '''
+    path = set()
+
+    def first(symbol):
+        if id(symbol) in path:
+            return None
+
+        path.add(id(symbol))
+        try:
+            if isinstance(symbol, String):
+                if not symbol.length:
+                    return [], True
+                return [(ord(symbol.pattern[0]), ord(symbol.pattern[0]))], False
+            if isinstance(symbol, Range):
+                return [(symbol.lo, symbol.hi)], False
+            if isinstance(symbol, NotChar):
+                bounds = [-1] + sum(symbol.ranges, []) + [MAX_CHAR_CODE + 1]
+                return [(bounds[i] + 1, bounds[i + 1] - 1) for i in range(0, len(bounds), 2)
+                    if bounds[i] + 1 <= bounds[i + 1] - 1], False
+            if isinstance(symbol, CharClass):
+                return [tuple(x) for x in symbol.ranges], False
+            if isinstance(symbol, Dot):
+                return [(0, MAX_CHAR_CODE)], False
+            if isinstance(symbol, Choice):
+                return combine(symbol.symbol, True)
+            if isinstance(symbol, Sequence):
+                return combine(symbol.symbol, False)
+            if isinstance(symbol, (Star, Optional)):
+                result = first(symbol.symbol)
+                return None if result is None else (result[0], True)
+            if isinstance(symbol, Plus):
+                return first(symbol.originalSymbol)
+            if isinstance(symbol, (Ignore, Regular)) or type(symbol) is Symbol:
+                return ([], True) if symbol.symbol is None else first(symbol.symbol)
+            return None
+        finally:
+            path.discard(id(symbol))
+
+    def combine(symbols, choice):
+        ''' A choice is nullable if any alternative is, a sequence if all
+        its items are. Items after a non nullable one are never first.
+        '''
+        ranges = []
+        for x in symbols:
+            result = first(x)
+            if result is None:
+                return None
+            ranges.extend(result[0])
+            if result[1] == choice:
+                return ranges, choice
+        return ranges, not choice
+
+    return first(symbol)
+
+
+def ignoredText(yytext):
+    ''' Returns the text of the outermost YYignore objects in a tree
+    '''
+    if isinstance(yytext, YYignore):
+        return yytext.yytext
+    return ''.join(ignoredText(x) for x in yytext.child)
+
+
+class Regular(Symbol):
+    ''' Matches a regular PEG object (see toRegexp) with a single
+    precompiled regular expression, so the whole object is scanned in C.
+    The result is a flat YYtext (YYignore for Ignore objects) with no
+    children, also for non string inputs, where the object is matched
+    as usual. Text matched by nested Ignore objects (e.g. a trailing
+    Spacing) is kept apart, in a YYignore child.
+    Objects with no regexp equivalent are matched as usual.
+    '''
+    def __init__(self, x):
+        self.symbol = Symbol.symbol(x)
+        self.ignored = [] # Regexp groups matching nested Ignore objects
+        symbol = self.symbol
+        while isinstance(symbol, Regular):
+            symbol = symbol.symbol
+        self.ignore = isinstance(symbol, Ignore) # Whole matches are ignored
+        try:
+            self.regexp = re.compile(toRegexp(self.symbol, self.ignored), re.DOTALL)
+        except (NotRegular, re.error, AssertionError): # sre asserts on > 100 groups
+            self.regexp = None
+
+        # Objects which match the empty string unless the next char is one
+        # of a few (e.g. Spacing) skip the regexp call on any other char
+        self.skip = None
+        first = firstChars(self.symbol)
+        if first is not None and first[1] and all(b < CHARCLASS_MASK_LIMIT for a, b in first[0]):
+            codes = [x for a, b in first[0] for x in range(a, b + 1)]
+            self.skip = frozenset(codes) # Char codes, for str and unicode inputs
+
+    def parse(self, inputSequence, pos):
+        seq = inputSequence.inputSeq
+        if self.regexp is None:
+            return self.symbol.parse(inputSequence, pos)
+
+        if not isinstance(seq, basestring):
+            result = self.symbol.parse(inputSequence, pos)
+            if result is None:
+                return None
+            if isinstance(result, YYignore):
+                return self.flat(pos, result.yytext)
+            return self.flat(pos, str(result), ignoredText(result))
+
+        if self.skip is not None and (pos >= len(seq) or ord(seq[pos]) not in self.skip):
+            return self.flat(pos, seq[pos:pos])
+
+        match = self.regexp.match(seq, pos)
+        if match is None:
+            return None
+
+        if not self.ignored or self.ignore:
+            return self.flat(pos, match.group())
+
+        # Text of the (outermost) ignored groups is moved apart
+        text = ignored = seq[pos:pos]
+        end = pos
+        for start, stop in sorted((match.span(x) for x in self.ignored), key = lambda x: (x[0], -x[1])):
+            if start >= end:
+                text += seq[end:start]
+                ignored += seq[start:stop]
+                end = stop
+        return self.flat(pos, text + seq[end:match.end()], ignored)
+
+    def flat(self, pos, text, ignored = ''):
+        ''' Returns the YYtext for a match of the given text at pos,
+        and the given (nested) ignored text
+        '''
+        if self.ignore:
+            return YYignore(self, pos, text, None, name = self.name)
+
+        result = YYtext(self, pos, text, name = self.name)
+        if ignored:
+            result.child = [YYignore(self, pos + len(text), ignored, None, name = self.name)]
+        return result
+
+    def toStr(self):
+        return str(self.symbol)
+
+
 
 if __name__ == '__main__':
     S = String('333')
@@ -494,6 +1251,12 @@ if __name__ == '__main__':
     print Not(Dot()).match('a')
 
     print Range('a', 'c'), Range('a', 'c').match('b')
+    print CharClass(('a', 'z'), '_'), CharClass(('a', 'z'), '_').match('_')
+    print CharClass(('a', 'f'), ('d', 'z'), 'b'), \
+        CharClass(('a', 'z'), (u'\u0100', u'\uffff')).match(u'\u0410') is not None
     print Not(('a', 'b', 'c'))
+    print Regular(Star(Sequence(Not('b'), Dot()))).match('aaabaa')
+    print String('a').key() == String('a').key(), Not('a').key() == (~String('a')).key(), \
+        Range('0', '9').key() == Range('0', '9').key()
     print String('a') * ('a', 'b', 'c')
     print ('a', 'b', 'c') * String('a')
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-BUFFSIZE = 1024
+import os
+import mmap
+
+BUFFSIZE = mmap.PAGESIZE
 
 class Stream(object):
-    ''' Uses a file like an array
+    ''' Uses a file like an array.
+    The file is memory mapped, so the kernel does the paging. Files
+    which can not be mapped (e.g. empty ones, or too large for a 32 bit
+    address space) are read through a buffer.
     '''
     def __init__(self, filename):
         self.f = open(filename, 'rb')
@@ -12,7 +18,11 @@ class Stream(object):
         self.f.seek(0, os.SEEK_END);
         self.length = self.f.tell()
         self.f.seek(0, os.SEEK_SET);
-        self.buff = self.f.read(BUFFSIZE)
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (ValueError, OverflowError, EnvironmentError):
+            self.mm = None
+            self.buff = self.f.read(BUFFSIZE)
 
     def __len__(self):
         return self.length
@@ -21,11 +31,18 @@ class Stream(object):
         if not isinstance(s, slice):
             s = slice(s, s + 1, 1)
 
+        if self.mm is not None:
+            return self.mm[s]
+
         i, j, k = s.indices(self.length)
-        if i < self.pos or i >= self.pos + BUFFSIZE:
-            self.pos = i
-            self.f.seek(i, os.SEEK_SET)
-            self.buff = self.f.read(BUFFSIZE)
+        if k < 0:
+            return self[j + 1:i + 1][::-1][::-k]
 
-        return self.buff[i - self.pos:j - self.pos:k]
+        j = max(i, j)
+        if i < self.pos or j > self.pos + len(self.buff):
+            # Aligned to a buffer boundary, so backward steps stay inside
+            self.pos = i - i % BUFFSIZE
+            self.f.seek(self.pos, os.SEEK_SET)
+            self.buff = self.f.read(max(BUFFSIZE, j - self.pos))
 
+        return self.buff[i - self.pos:j - self.pos:k]
@@ -0,0 +1,707 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# A PEG parsing machine, as described by Medeiros & Ierusalimschy in
+# "A Parsing Machine for PEGs" (the one LPEG is built on).
+# A PEG object tree is compiled once into flat opcode / operand arrays,
+# which are run by a single dispatch loop with an explicit backtrack
+# stack, so deeply nested input does not exhaust the Python stack.
+# Parse trees are recorded as a flat list of captures, built into
+# YYtext objects once the match succeeds. The loop only uses ints and
+# arrays, so it is JIT compiled with numba when available.
+
+from array import array
+
+from peg import *
+
+# Opcodes
+OP_END = 0          # Success. Returns the current position
+OP_STRING = 1       # Matches the string stored at consts[arg]
+OP_ANY = 2          # Matches any char
+OP_SET = 3          # Matches a char in the set stored at consts[arg]
+OP_CHOICE = 4       # Pushes a backtrack entry to resume at arg
+OP_COMMIT = 5       # Pops a backtrack entry and jumps to arg
+OP_LOOP = 6         # Pops a backtrack entry. Jumps to arg if input was consumed
+OP_BACKCOMMIT = 7   # Pops a backtrack entry, restores its position and jumps to arg
+OP_FAILTWICE = 8    # Pops a backtrack entry and fails
+OP_FAIL = 9         # Fails: backtracks to the last backtrack entry
+OP_JUMP = 10        # Jumps to arg
+OP_CALL = 11        # Pushes a return entry and jumps to arg
+OP_RET = 12         # Pops a return entry and jumps back
+OP_OPEN = 13        # Opens a capture of the symbol number arg
+OP_CLOSE = 14       # Closes the last open capture
+OP_FULL = 15        # Captures the symbol number arg just matched (a leaf)
+OP_SPAN = 16        # Matches as many chars in the set at consts[arg] as possible
+OP_TESTSET = 17     # Jumps to consts[arg] unless the char is in the set at consts[arg + 1]
+OP_UNTIL = 18       # Matches up to the next string stored at consts[arg], or the end
+
+# Initial backtrack stack and capture list sizes (in entries).
+# Doubled on overflow.
+STACKSIZE = 256
+CAPSIZE = 1024
+
+
+class VMerror(Exception):
+    def __init__(self, msg):
+        self.message = msg
+
+    def __str__(self):
+        return self.message
+
+
+def inSet(consts, table, offset, code):
+    ''' Returns whether the char code is in the set stored at consts[offset]
+    '''
+    if code < 256:
+        return table[consts[offset] * 256 + code] != 0
+
+    for i in range(consts[offset + 1]):
+        if consts[offset + 2 + 2 * i] <= code <= consts[offset + 3 + 2 * i]:
+            return True
+    return False
+
+
+def run(ops, args, consts, table, text, n, pos, stack, caps):
+    ''' Runs the program from pc 0 over the char codes in text[:n]
+    starting at pos. Returns (end position, number of captures) on
+    success, (-1, 0) on failure, or (-2, 0) / (-3, 0) if the stack
+    (3 ints per entry) or the capture list (2 ints per entry) overflows.
+    Backtrack entries store the pc, position and number of captures to
+    restore. Return entries are stored with a position of -1.
+    Captures are stored as (symbol number + 1, position) for OPEN,
+    (0, position) for CLOSE and (-symbol number - 1, end position) for
+    FULL instructions.
+    '''
+    pc = 0
+    top = 0
+    ncap = 0
+    size = len(stack)
+    capsize = len(caps)
+
+    while True:
+        op = ops[pc]
+        arg = args[pc]
+        fail = False
+
+        if op == OP_STRING:
+            length = consts[arg]
+            if pos + length > n:
+                fail = True
+            else:
+                for i in range(length):
+                    if text[pos + i] != consts[arg + 1 + i]:
+                        fail = True
+                        break
+                if not fail:
+                    pos += length
+                    pc += 1
+        elif op == OP_SET:
+            if pos < n and inSet(consts, table, arg, text[pos]):
+                pos += 1
+                pc += 1
+            else:
+                fail = True
+        elif op == OP_SPAN:
+            while pos < n and inSet(consts, table, arg, text[pos]):
+                pos += 1
+            pc += 1
+        elif op == OP_UNTIL:
+            length = consts[arg]
+            while pos < n:
+                found = pos + length <= n
+                for i in range(length):
+                    if not found or text[pos + i] != consts[arg + 1 + i]:
+                        found = False
+                        break
+                if found:
+                    break
+                pos += 1
+            pc += 1
+        elif op == OP_TESTSET:
+            if pos < n and inSet(consts, table, consts[arg + 1], text[pos]):
+                pc += 1
+            else:
+                pc = consts[arg]
+        elif op == OP_ANY:
+            if pos >= n:
+                fail = True
+            else:
+                pos += 1
+                pc += 1
+        elif op == OP_CHOICE:
+            if top + 3 > size:
+                return -2, 0
+            stack[top] = arg
+            stack[top + 1] = pos
+            stack[top + 2] = ncap
+            top += 3
+            pc += 1
+        elif op == OP_COMMIT:
+            top -= 3
+            pc = arg
+        elif op == OP_LOOP:
+            top -= 3
+            if pos != stack[top + 1]:
+                pc = arg
+            else: # An empty iteration ends the loop, and is dropped
+                ncap = stack[top + 2]
+                pc += 1
+        elif op == OP_BACKCOMMIT:
+            top -= 3
+            pos = stack[top + 1]
+            ncap = stack[top + 2]
+            pc = arg
+        elif op == OP_FAILTWICE:
+            top -= 3
+            fail = True
+        elif op == OP_FAIL:
+            fail = True
+        elif op == OP_JUMP:
+            pc = arg
+        elif op == OP_CALL:
+            if top + 3 > size:
+                return -2, 0
+            stack[top] = pc + 1
+            stack[top + 1] = -1
+            top += 3
+            pc = arg
+        elif op == OP_RET:
+            top -= 3
+            pc = stack[top]
+        elif op == OP_OPEN or op == OP_CLOSE or op == OP_FULL:
+            if 2 * ncap + 2 > capsize:
+                return -3, 0
+            if op == OP_OPEN:
+                caps[2 * ncap] = arg + 1
+            elif op == OP_CLOSE:
+                caps[2 * ncap] = 0
+            else:
+                caps[2 * ncap] = -arg - 1
+            caps[2 * ncap + 1] = pos
+            ncap += 1
+            pc += 1
+        else: # OP_END
+            return pos, ncap
+
+        if fail:
+            while top > 0 and stack[top - 2] == -1: # Discards return entries
+                top -= 3
+            if top == 0:
+                return -1, 0
+            top -= 3
+            pc = stack[top]
+            pos = stack[top + 1]
+            ncap = stack[top + 2]
+
+
+try:
+    import numpy
+    from numba import njit
+    inSet = njit(cache = True)(inSet)
+    run = njit(cache = True)(run)
+except ImportError:
+    numpy = None
+
+
+class Program(object):
+    ''' A compiled PEG object: opcodes, operands, constants and
+    char set tables, ready to be run by the parsing machine.
+    '''
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.ops = array('i')
+        self.args = array('i')
+        self.consts = array('i')
+        self.table = array('B')
+        self.sets = {} # CharClass ranges => consts offset
+        self.symbols = [] # Captured symbols, by number
+        self.numbers = {} # id(symbol) => number
+
+    def emit(self, op, arg = 0):
+        ''' Appends an instruction. Returns its address.
+        '''
+        self.ops.append(op)
+        self.args.append(arg)
+        return len(self.ops) - 1
+
+    def patch(self, addr, arg = None):
+        ''' Sets the operand of the instruction at addr
+        (defaults to the next instruction address)
+        '''
+        self.args[addr] = len(self.ops) if arg is None else arg
+
+    def addString(self, pattern):
+        ''' Stores a string as [length, code0, code1...].
+        Returns its consts offset.
+        '''
+        offset = len(self.consts)
+        self.consts.append(len(pattern))
+        self.consts.extend(ord(c) for c in pattern)
+        return offset
+
+    def addSet(self, ranges):
+        ''' Stores a list of (lo, hi) char code ranges as a 256 entry
+        table row for codes < 256, and a list of ranges for the rest.
+        Returns its consts offset.
+        '''
+        key = tuple(tuple(x) for x in ranges)
+        if key in self.sets:
+            return self.sets[key]
+
+        row = [0] * 256
+        wide = []
+        for a, b in ranges:
+            for code in xrange(a, min(b, 255) + 1):
+                row[code] = 1
+            if b > 255:
+                wide.append((max(a, 256), b))
+
+        offset = len(self.consts)
+        self.consts.extend([len(self.table) // 256, len(wide)])
+        for a, b in wide:
+            self.consts.extend([a, b])
+        self.table.extend(row)
+        self.sets[key] = offset
+        return offset
+
+    def addTest(self, ranges):
+        ''' Stores a TESTSET operand [jump address, set offset] for the
+        given ranges. Returns its consts offset. The jump address must
+        be set with patchTest.
+        '''
+        setOffset = self.addSet(ranges)
+        offset = len(self.consts)
+        self.consts.extend([0, setOffset])
+        return offset
+
+    def patchTest(self, offset):
+        ''' Sets the jump address of the TESTSET operand at the given
+        consts offset to the next instruction address
+        '''
+        self.consts[offset] = len(self.ops)
+
+    def addSymbol(self, symbol):
+        ''' Returns the capture number of the given symbol
+        '''
+        if id(symbol) not in self.numbers:
+            self.numbers[id(symbol)] = len(self.symbols)
+            self.symbols.append(symbol)
+        return self.numbers[id(symbol)]
+
+    def codes(self, inputSequence):
+        ''' Returns the input char codes as an array
+        '''
+        if not isinstance(inputSequence, InputSeq):
+            inputSequence = InputSeq(inputSequence)
+
+        result = inputSequence.codes
+        if isinstance(result, Codes):
+            result = array('i', [ord(c) for c in inputSequence[:]])
+
+        if numpy is not None:
+            result = numpy.frombuffer(result, dtype = 'B' if isinstance(result, bytearray) else result.typecode)
+        return result
+
+    def execute(self, inputSequence, pos):
+        ''' Runs the program over the input at the given position.
+        Returns (end position or -1, number of captures, captures).
+        '''
+        text = self.codes(inputSequence)
+        ops, args, consts, table = self.ops, self.args, self.consts, self.table
+        if numpy is not None:
+            ops, args, consts, table = [numpy.frombuffer(x, dtype = x.typecode)
+                for x in (ops, args, consts, table)]
+
+        size = STACKSIZE
+        capsize = CAPSIZE if self.symbols else 1
+        while True:
+            stack = array('i', [0]) * (3 * size)
+            caps = array('i', [0]) * (2 * capsize)
+            if numpy is not None:
+                stack = numpy.frombuffer(stack, dtype = stack.typecode)
+                caps = numpy.frombuffer(caps, dtype = caps.typecode)
+
+            result, ncap = run(ops, args, consts, table, text, len(text), pos, stack, caps)
+            if result == -2:
+                size *= 2
+            elif result == -3:
+                capsize *= 2
+            else:
+                return result, ncap, caps
+
+    def run(self, inputSequence, pos = 0):
+        ''' Matches the program against the input at the given position.
+        Returns the end position, or None if the input does not match.
+        '''
+        result = self.execute(inputSequence, pos)[0]
+        return None if result < 0 else result
+
+    def match(self, inputSequence, pos = 0):
+        ''' Matches the program (compiled with captures) against the
+        input at the given position. Returns the same YYtext tree the
+        PEG object match() method does, or None if it does not match.
+        '''
+        result, ncap, caps = self.execute(inputSequence, pos)
+        if result < 0:
+            return None
+
+        # Each open capture is a [symbol, position, children] list
+        captures = [[None, pos, []]]
+        for i in xrange(0, 2 * ncap, 2):
+            number, end = caps[i], caps[i + 1]
+            if number > 0:
+                captures.append([self.symbols[number - 1], end, []])
+            elif number < 0:
+                captures[-1][2].append(self.leaf(self.symbols[-number - 1], inputSequence, end))
+            else:
+                symbol, start, child = captures.pop()
+                captures[-1][2].append(self.node(symbol, inputSequence, start, end, child))
+
+        child = captures[0][2]
+        return child[0] if child else YYtext(self.symbol, pos, '', name = self.symbol.name)
+
+    def nodes(self, inputSequence, pos = 0):
+        ''' As match(), but returns the parse tree in columnar form (see
+        Nodes), with no YYtext object, or None if it does not match.
+        '''
+        result, ncap, caps = self.execute(inputSequence, pos)
+        if result < 0:
+            return None
+
+        tree = Nodes(inputSequence, self.symbols + [self.symbol])
+        parents = [-1] # Open nodes
+        hidden = 0 # Open captures inside a Regular or Ignore one
+        for i in xrange(0, 2 * ncap, 2):
+            number, end = caps[i], caps[i + 1]
+            if hidden:
+                hidden += 1 if number > 0 else -1 if number == 0 else 0
+                if hidden: # Not its end
+                    continue
+
+            if number > 0:
+                parents.append(tree.add(number - 1, end, end, parents[-1]))
+                if isinstance(self.symbols[number - 1], (Regular, Ignore)):
+                    hidden = 1 # A leaf, as in match() trees
+            elif number < 0:
+                symbol = self.symbols[-number - 1]
+                if isinstance(symbol, String):
+                    start = end - symbol.length
+                elif isinstance(symbol, (And, Not)):
+                    start = end
+                else:
+                    start = end - 1 # A single char
+                tree.add(-number - 1, start, end, parents[-1])
+            else:
+                tree.end[parents.pop()] = end
+
+        if not len(tree):
+            tree.add(len(self.symbols), pos, pos, -1)
+        return tree
+
+    def leaf(self, symbol, inputSequence, end):
+        ''' Returns the YYtext of a leaf symbol match ending at end
+        '''
+        if isinstance(symbol, String):
+            return YYtext(symbol, end - symbol.length, symbol.pattern, symbol.name)
+
+        if isinstance(symbol, (And, Not)):
+            return YYtext(symbol, end, '', name = symbol.name)
+
+        return YYtext(symbol, end - 1, inputSequence[end - 1], name = symbol.name) # A single char
+
+    def node(self, symbol, inputSequence, start, end, child):
+        ''' Returns the YYtext of a symbol match, given its children
+        '''
+        if isinstance(symbol, Regular):
+            if symbol.ignored: # Matches again, to tell the ignored text apart
+                if not isinstance(inputSequence, InputSeq):
+                    inputSequence = InputSeq(inputSequence)
+                return symbol.parse(inputSequence, start)
+            return symbol.flat(start, inputSequence[start:end])
+
+        if isinstance(symbol, Ignore):
+            if not child: # Compiled with no captures
+                return YYignore(symbol, start, inputSequence[start:end], None, name = symbol.name)
+            return YYignore(symbol, start, inputSequence[start:end], child[0], name = symbol.name)
+
+        result = YYtext(symbol, start, '') # Sequence, Choice and Star
+        result.child = child
+        return result
+
+
+class Nodes(object):
+    ''' A parse tree stored by columns, in int arrays, rather than as
+    YYtext objects. Node 0 is the root, and node i is a match of
+    symbols[symbol[i]] spanning input[start[i]:end[i]]. Its children are
+    firstChild[i], then their nextSibling[] in turn (-1 ends them).
+    Regular and Ignore matches are leaves, as they are flat YYtext ones.
+    '''
+    def __init__(self, inputSequence, symbols):
+        self.inputSequence = inputSequence
+        self.symbols = symbols
+        self.symbol = array('i')
+        self.start = array('i')
+        self.end = array('i')
+        self.parent = array('i')
+        self.firstChild = array('i')
+        self.nextSibling = array('i')
+        self.__last = {} # Node => its last child so far
+
+    def __len__(self):
+        return len(self.symbol)
+
+    def add(self, symbol, start, end, parent):
+        ''' Appends a node, as the last child of the parent one (if not -1).
+        Returns its number.
+        '''
+        i = len(self.symbol)
+        for column, value in ((self.symbol, symbol), (self.start, start), (self.end, end),
+                (self.parent, parent), (self.firstChild, -1), (self.nextSibling, -1)):
+            column.append(value)
+
+        if parent >= 0:
+            if parent in self.__last:
+                self.nextSibling[self.__last[parent]] = i
+            else:
+                self.firstChild[parent] = i
+            self.__last[parent] = i
+        return i
+
+    def children(self, i):
+        ''' Returns the list of children nodes of node i
+        '''
+        result = []
+        i = self.firstChild[i]
+        while i >= 0:
+            result.append(i)
+            i = self.nextSibling[i]
+        return result
+
+    def text(self, i):
+        ''' Returns the input matched by node i
+        '''
+        return self.inputSequence[self.start[i]:self.end[i]]
+
+
+def references(symbol, count = None):
+    ''' Returns a dict {id(symbol): number of references} for every
+    symbol reachable from the given one.
+    '''
+    if count is None:
+        count = {}
+
+    stack = [symbol]
+    while stack:
+        symbol = stack.pop()
+        count[id(symbol)] = count.get(id(symbol), 0) + 1
+        if count[id(symbol)] == 1:
+            stack.extend(children(symbol))
+
+    return count
+
+
+def children(symbol):
+    ''' Returns the list of subsymbols of a PEG object
+    '''
+    if isinstance(symbol, (String, Regexp, CharClass, Dot)):
+        return []
+
+    if isinstance(symbol, Sequence): # Also Choice
+        return list(symbol.symbol)
+
+    if isinstance(symbol, Symbol) and isinstance(symbol.symbol, Symbol):
+        return [symbol.symbol]
+
+    return []
+
+
+def charRanges(symbol, seen = ()):
+    ''' Returns the list of (lo, hi) char code ranges of a PEG object
+    matching a single char of a set, e.g. [a-z] or ('a' | 'b'),
+    or None if it is not one.
+    '''
+    if isinstance(symbol, Choice) and symbol not in seen:
+        result = []
+        for x in symbol.symbol:
+            ranges = charRanges(x, seen + (symbol,))
+            if ranges is None:
+                return None
+            result.extend(ranges)
+        return result
+
+    if isinstance(symbol, String):
+        return [(ord(symbol.pattern), ord(symbol.pattern))] if symbol.length == 1 else None
+
+    if isinstance(symbol, (Range, CharClass, Dot)):
+        return firstChars(symbol)[0]
+
+    return None
+
+
+def hasIgnore(symbol):
+    ''' Returns whether an Ignore object is reachable from the given one.
+    If not, the text of its match is the input matched.
+    '''
+    stack = [symbol]
+    seen = set()
+    while stack:
+        symbol = stack.pop()
+        if isinstance(symbol, Ignore):
+            return True
+        if id(symbol) not in seen:
+            seen.add(id(symbol))
+            stack.extend(children(symbol))
+
+    return False
+
+
+def compile_to_bytecode(symbol, captures = False):
+    ''' Compiles the given PEG object into a Program.
+    Symbols referenced more than once (including recursive ones) are
+    compiled as subroutines. Raises VMerror for unsupported symbols.
+    If captures is True, the program records the parse tree, so its
+    match() method can be used.
+    '''
+    program = Program(symbol)
+    count = references(symbol)
+    subroutines = {} # (id(symbol), captures) => address
+    pending = [] # (call address, symbol, captures) to be patched
+
+    def compileSymbol(symbol, captures):
+        if isinstance(symbol, (String, Dot, Range, CharClass)) or count[id(symbol)] < 2:
+            compileBody(symbol, captures)
+        else:
+            pending.append((program.emit(OP_CALL), symbol, captures))
+
+    def compileBody(symbol, captures):
+        if isinstance(symbol, String):
+            if symbol.length:
+                program.emit(OP_STRING, program.addString(symbol.pattern))
+        elif isinstance(symbol, Range):
+            program.emit(OP_SET, program.addSet([(ord(symbol.a), ord(symbol.b))]))
+        elif isinstance(symbol, Regexp):
+            raise VMerror('Regular expressions can not be compiled: %s' % symbol)
+        elif isinstance(symbol, NotChar):
+            choice = program.emit(OP_CHOICE)
+            program.emit(OP_SET, program.addSet(symbol.ranges))
+            program.emit(OP_FAILTWICE)
+            program.patch(choice)
+            program.emit(OP_ANY)
+        elif isinstance(symbol, CharClass):
+            program.emit(OP_SET, program.addSet(symbol.ranges))
+        elif isinstance(symbol, Dot):
+            program.emit(OP_ANY)
+        elif isinstance(symbol, Ignore) and captures and not hasIgnore(symbol.symbol):
+            program.emit(OP_OPEN, program.addSymbol(symbol)) # Skipped, only its text is kept
+            compileSymbol(symbol.symbol, False)
+            program.emit(OP_CLOSE)
+            return
+        elif isinstance(symbol, (Sequence, Star, Ignore)) and captures: # Also Choice
+            program.emit(OP_OPEN, program.addSymbol(symbol))
+            compileNode(symbol, captures)
+            program.emit(OP_CLOSE)
+            return
+        elif isinstance(symbol, Regular) and symbol.regexp is not None and captures:
+            program.emit(OP_OPEN, program.addSymbol(symbol)) # Matched as a flat text
+            compileSymbol(symbol.symbol, False)
+            program.emit(OP_CLOSE)
+            return
+        else:
+            compileNode(symbol, captures)
+            return
+
+        if captures: # A leaf
+            program.emit(OP_FULL, program.addSymbol(symbol))
+
+    def compileNode(symbol, captures):
+        if isinstance(symbol, Choice):
+            commits = []
+            for x in symbol.symbol[:-1]:
+                # Alternatives which can not start at the next char are
+                # skipped with no backtrack entry
+                first = firstChars(x)
+                test = None
+                if first is not None and not first[1]:
+                    test = program.addTest(first[0])
+                    program.emit(OP_TESTSET, test)
+                choice = program.emit(OP_CHOICE)
+                compileSymbol(x, captures)
+                commits.append(program.emit(OP_COMMIT))
+                program.patch(choice)
+                if test is not None:
+                    program.patchTest(test)
+            compileSymbol(symbol.symbol[-1], captures)
+            for x in commits:
+                program.patch(x)
+        elif isinstance(symbol, Sequence):
+            for x in symbol.symbol:
+                compileSymbol(x, captures)
+        elif isinstance(symbol, Star) and not captures and charRanges(symbol.symbol) is not None:
+            program.emit(OP_SPAN, program.addSet(charRanges(symbol.symbol)))
+        elif isinstance(symbol, Star) and not captures and stopString(symbol.symbol) is not None:
+            program.emit(OP_UNTIL, program.addString(stopString(symbol.symbol)))
+        elif isinstance(symbol, Star):
+            choice = program.emit(OP_CHOICE)
+            compileSymbol(symbol.symbol, captures)
+            program.emit(OP_LOOP, choice)
+            program.patch(choice)
+        elif isinstance(symbol, And):
+            choice = program.emit(OP_CHOICE)
+            compileSymbol(symbol.symbol, False)
+            commit = program.emit(OP_BACKCOMMIT)
+            program.patch(choice)
+            program.emit(OP_FAIL)
+            program.patch(commit)
+            if captures:
+                program.emit(OP_FULL, program.addSymbol(symbol))
+        elif isinstance(symbol, Not):
+            choice = program.emit(OP_CHOICE)
+            compileSymbol(symbol.symbol, False)
+            program.emit(OP_FAILTWICE)
+            program.patch(choice)
+            if captures:
+                program.emit(OP_FULL, program.addSymbol(symbol))
+        elif isinstance(symbol, (Plus, Optional, Ignore, Regular)) or type(symbol) is Symbol:
+            if symbol.symbol is not None:
+                compileSymbol(symbol.symbol, captures)
+        else:
+            raise VMerror('Unsupported PEG object %s' % type(symbol).__name__)
+
+    compileBody(symbol, captures)
+    program.emit(OP_END)
+
+    while pending:
+        addr, symbol, captures = pending.pop()
+        key = (id(symbol), captures)
+        if key not in subroutines:
+            subroutines[key] = len(program.ops)
+            compileBody(symbol, captures)
+            program.emit(OP_RET)
+        program.patch(addr, subroutines[key])
+
+    return program
+
+
+if __name__ == '__main__':
+    S = compile_to_bytecode(Sequence(Star(String('a') | 'b'), String('c')))
+    print S.run('aababc'), S.run('aabab')
+
+    S = compile_to_bytecode(Sequence(Star(Sequence(Not('b'), Dot())), 'b'))
+    print S.run('aaab'), S.run('aaa')
+
+    number = Plus(CharClass('0', '1'))
+    factor = Sequence(number, '*', number) | number
+    factor.symbol[0].symbol[2] = factor
+    S = compile_to_bytecode(factor)
+    print S.run('10*11*1+'), S.run('+')
+
+    S = compile_to_bytecode(Sequence(And('a'), Optional('a'), Range('0', '9')))
+    print S.run('a5'), S.run('5')
+
+    S = compile_to_bytecode(Sequence(Star(String('a') | 'b'), String('c')), captures = True)
+    print S.match('aababc'), S.match('aabab')
+    T = S.nodes('abc')
+    print len(T), [T.text(i) for i in T.children(0)], S.nodes('ab')
+
+    S = compile_to_bytecode(Sequence(Star(Range('a', 'z')), String('1') | String('2') | '3'))
+    print S.run('abc3'), S.run('abc4'), list(S.ops)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Every engine must agree with the tree walker (PEG object match())
+# on random PEG objects and inputs:
+# - the parsing machine (Program.match trees, Program.nodes trees
+#   and Program.run ends),
+# - the generated Python recognizers (compileRecognizer),
+# - Regular objects (a single regexp match),
+# - the optimizer passes (optimize), on the trees rule actions see.
+# Usage: enginetest.py [seed] [number of objects]
+# Exits with status 1 if any of them disagree.
+
+import sys
+import random
+
+from peggy.peg import *
+from peggy import vm
+from peggy import codegen
+from peggy.optimize import optimize
+
+
+def randomSymbol(depth):
+    ''' Returns a random PEG object matching strings of a, b and c
+    '''
+    if depth <= 0 or random.random() < 0.3:
+        return random.choice([
+            lambda: String(random.choice(['a', 'b', 'ab', 'ba', ''])),
+            lambda: Dot(),
+            lambda: Range('a', 'b'),
+            lambda: CharClass('a', 'c'),
+            lambda: NotChar('b'),
+            lambda: Choice(String('a'), String('c'), String('ab'))])()
+
+    x = lambda: randomSymbol(depth - 1)
+    return random.choice([
+        lambda: Sequence(*[x() for i in range(random.randint(1, 3))]),
+        lambda: Choice(*[x() for i in range(random.randint(2, 3))]),
+        lambda: Choice(Sequence('a', x()), Sequence('a', x(), x()), x()), # Common prefixes
+        lambda: Star(x()),
+        lambda: Plus(x()),
+        lambda: Optional(x()),
+        lambda: And(x()),
+        lambda: Not(x()),
+        lambda: Sequence(Not(x()), Dot()),
+        lambda: Ignore(x()),
+        lambda: Regular(x())])()
+
+
+def randomInput():
+    result = ''.join(random.choice('abc') for i in range(random.randint(0, 8)))
+    if random.random() < 0.2:
+        result = unicode(result) + unichr(300)
+    return result
+
+
+def tree(yytext, identity = True):
+    ''' Returns a parse tree as a string, to compare them. Symbols are
+    told apart by identity, or else by their class.
+    '''
+    if yytext is None:
+        return 'None'
+
+    symbol = id(yytext.symbol) if identity else type(yytext.symbol).__name__
+    return '%s/%s/%r@%i:%i:%r[%s]' % (type(yytext).__name__, symbol, yytext.name, yytext.pos,
+        len(yytext), yytext.__str__(), ','.join(tree(x, identity) for x in yytext.child))
+
+
+def spans(yytext):
+    ''' Returns the symbols and spans of a parse tree as a string, to
+    compare it with a vm.Nodes one, where Regular matches are leaves
+    (with no YYignore child for nested ignored text)
+    '''
+    if yytext is None:
+        return 'None'
+
+    child = [] if isinstance(yytext.symbol, Regular) else yytext.child
+    return '%i@%i:%i[%s]' % (id(yytext.symbol), yytext.pos, len(yytext),
+        ','.join(spans(x) for x in child))
+
+
+def nodeSpans(nodes, i = 0):
+    ''' As above, for node i of a vm.Nodes tree
+    '''
+    if nodes is None:
+        return 'None'
+
+    return '%i@%i:%i[%s]' % (id(nodes.symbols[nodes.symbol[i]]), nodes.start[i],
+        nodes.end[i] - nodes.start[i], ','.join(nodeSpans(nodes, x) for x in nodes.children(i)))
+
+
+def flat(yytext):
+    ''' Returns the length and text of a match (or None), to compare them
+    '''
+    return None if yytext is None else (len(yytext), yytext.__str__())
+
+
+def check(seed, count):
+    ''' Returns the number of mismatches found
+    '''
+    errors = [0]
+
+    def error(engine, symbol, text, pos, expected, result):
+        errors[0] += 1
+        if errors[0] <= 5:
+            print 'MISMATCH (%s) %s %r at %i:\n  %s\n  %s' % (engine, symbol, text, pos, expected, result)
+
+    for i in xrange(count):
+        random.seed(seed * 1000003 + i)
+        symbol = randomSymbol(4)
+        random.seed(seed * 1000003 + i)
+        optimized = optimize(randomSymbol(4)) # The same object, optimized
+
+        machine = vm.compile_to_bytecode(symbol, captures = True)
+        program = vm.compile_to_bytecode(symbol)
+        recognizer = codegen.compileRecognizer(symbol)
+        regular = Regular(symbol)
+
+        for j in xrange(6):
+            text = randomInput()
+            pos = random.randint(0, len(text))
+            result = symbol.match(text, pos)
+            end = None if result is None else pos + len(result)
+
+            if tree(machine.match(text, pos)) != tree(result):
+                error('machine', symbol, text, pos, tree(result), tree(machine.match(text, pos)))
+            if nodeSpans(machine.nodes(text, pos)) != spans(result):
+                error('machine nodes', symbol, text, pos, spans(result), nodeSpans(machine.nodes(text, pos)))
+            if program.run(text, pos) != end:
+                error('machine run', symbol, text, pos, end, program.run(text, pos))
+            if recognizer(text, pos) != end:
+                error('recognizer', symbol, text, pos, end, recognizer(text, pos))
+            if regular.regexp is not None:
+                match = regular.match(text, pos)
+                if flat(match) != flat(result):
+                    error('Regular', symbol, text, pos, tree(result), tree(match))
+            if tree(optimized.match(text, pos), False) != tree(result, False):
+                error('optimize', symbol, text, pos, tree(result, False), tree(optimized.match(text, pos), False))
+
+    return errors[0]
+
+
+
+if __name__ == '__main__':
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    errors = check(seed, count)
+    print '%i mismatches' % errors
+    sys.exit(1 if errors else 0)